@@ -5,8 +5,17 @@
 
 import sys
 import socket
+import os
 import selectors
 import types
+import threading
+import queue
+import time
+import csv
+import gzip
+import json
+import shutil
+import tempfile
 
 
 HOST = "127.0.0.1"      # Standard loopback interface address (localhost)
@@ -14,6 +23,14 @@ PORT = 65432            # Port to listen on (non-privileged ports are > 1023)
 ALL_ACCOUNTS = dict()   # keys are account numbers, value are BankAccount instances
 ACTIVE_ACCOUNTS = dict() # keys are account numbers, values are the IP addresses of the clients currently accessing the account
 ACCT_FILE = "accounts.txt"
+EXPORT_FILE = None      # if set, path of the periodic balance export, e.g. "balances.csv.gz" or "balances.jsonl"
+EXPORT_INTERVAL = 3600  # seconds between periodic exports
+EXPORT_CHUNK_ROWS = 500 # number of rows buffered before each write to the export file
+IO_THREADS = 0          # number of I/O threads servicing clients; 0 runs the original single-threaded select loop
+WORKER_POLL_INTERVAL = 0.05 # seconds an I/O thread waits in select() before checking for newly accepted connections
+QUIET = False           # if True, skip the per-request tracing messages (used by stress_bank_server)
+LOCK_STRIPES = 64       # number of locks shared among all accounts, see acct_lock()
+ACCOUNT_LOCKS = [threading.Lock() for _ in range(LOCK_STRIPES)]
 
 ##########################################################
 #                                                        #
@@ -45,7 +62,7 @@ def amountIsValid(amount):
     (B) a positive value with at most two decimal places."""
     try:
         amount = float(amount)
-    except ValueError: 
+    except (TypeError, ValueError): # TypeError: as_numeric gives None for non-numeric request amounts
         return False
     return (round(amount, 2) == amount) and (amount >= 0)
 
@@ -57,6 +74,16 @@ def as_numeric(amount):
     except ValueError:
         return None
 
+def log(msg):
+    '''Print a per-request tracing message to the server console, unless QUIET is set.'''
+    if not QUIET:
+        print(msg)
+
+def acct_lock(acct_num):
+    '''Return the lock guarding acct_num's balance and busy marking. Accounts are spread over LOCK_STRIPES locks,
+    so threads working on different accounts rarely wait on each other.'''
+    return ACCOUNT_LOCKS[hash(acct_num) % LOCK_STRIPES]
+
 class BankAccount:
     """BankAccount instances are used to encapsulate various details about individual bank accounts."""
     acct_number = ''        # a unique account number
@@ -81,7 +108,8 @@ class BankAccount:
             result_code = 1
         else:
             # valid amount, so add it to balance and set succes_code 1
-            self.acct_balance = round(self.acct_balance + amount, 2)
+            with acct_lock(self.acct_number): # the read-modify-write must not interleave with another thread's
+                self.acct_balance = round(self.acct_balance + amount, 2)
         return result_code
 
     def withdraw(self, amount):
@@ -91,13 +119,14 @@ class BankAccount:
         result_code = 0
         if not amountIsValid(amount):
             # invalid amount, return error 
-            result_code = 1
-        elif amount > self.acct_balance:
-            # attempted overdraft
-            result_code = 2
-        else:
-            # all checks out, subtract amount from the balance
-            self.acct_balance = round(self.acct_balance - amount, 2)
+            return 1
+        with acct_lock(self.acct_number): # the overdraft check and the update must see the same balance
+            if amount > self.acct_balance:
+                # attempted overdraft
+                result_code = 2
+            else:
+                # all checks out, subtract amount from the balance
+                self.acct_balance = round(self.acct_balance - amount, 2)
         return result_code
 
 def get_acct(acct_num):
@@ -155,9 +184,105 @@ def save_all_accounts(acct_file = "accounts.txt"):
     ''' Save all accounts stored in runtime database, writing to acct_file.'''
     print(f"storing account data to file: {acct_file}")
     with open(acct_file, "w") as f:
-        for acct in ALL_ACCOUNTS.values: # Overwrites any comments
-            f.write(f"{acct.acct_number}, {acct.acct_pin}, {acct.acct_balance}")
-            
+        for acct in iter_accounts(): # Overwrites any comments
+            f.write(f"{acct.acct_number}, {acct.acct_pin}, {acct.acct_balance}\n")
+
+##########################################################
+#                                                        #
+# Bank Server Export                                     #
+#                                                        #
+# Streams account balances out for downstream systems.   #
+#                                                        #
+##########################################################
+
+def iter_accounts():
+    ''' Yield the BankAccount instances in the ALL_ACCOUNTS database one at a time, without copying the database. '''
+    for acct in ALL_ACCOUNTS.values():
+        yield acct
+
+def iter_balance_rows():
+    ''' Yield one (account number, balance) tuple per account. PINs are never exported. '''
+    for acct in iter_accounts():
+        yield acct.acct_number, acct.acct_balance
+
+def chunked(rows, size):
+    ''' Group the rows yielded by a generator into lists of at most size rows, so at most one chunk is held in memory. '''
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def open_export_file(export_file, path):
+    ''' Open path for writing text on behalf of export_file. If export_file ends in ".gz" the output is gzip compressed. '''
+    if export_file.endswith(".gz"):
+        return gzip.open(path, "wt", newline="")
+    return open(path, "w", newline="")
+
+def export_balances(export_file, rows=None):
+    ''' Write account balances to export_file, one chunk of rows at a time, so memory use does not grow with the number of accounts.
+    The format is chosen from the file name: ".jsonl" (optionally ".jsonl.gz") writes JSON lines, anything else writes CSV with a header.
+    rows defaults to iter_balance_rows(). Returns the number of rows written.
+    The rows go to a temporary file next to export_file, which replaces export_file only once it is complete,
+    so readers never see a partly written export. The new file keeps the permissions of the one it replaces;
+    a first export gets the usual permissions for new files (subject to the umask). '''
+    if rows is None:
+        rows = iter_balance_rows()
+    as_jsonl = export_file.removesuffix(".gz").endswith(".jsonl")
+    count = 0
+    print(f"exporting account balances to file: {export_file}")
+    # Unique per process and thread, and in the same directory so os.replace() is an atomic rename.
+    tmp_file = os.path.join(os.path.dirname(os.path.abspath(export_file)),
+                            f".{os.path.basename(export_file)}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open_export_file(export_file, tmp_file) as f:
+            if not as_jsonl:
+                writer = csv.writer(f)
+                writer.writerow(("acct_number", "balance"))
+            for chunk in chunked(rows, EXPORT_CHUNK_ROWS):
+                if as_jsonl:
+                    f.write("".join(json.dumps({"acct_number": num, "balance": bal}) + "\n" for num, bal in chunk))
+                else:
+                    writer.writerows(chunk)
+                count += len(chunk)
+        if os.path.exists(export_file):
+            shutil.copymode(export_file, tmp_file)
+        os.replace(tmp_file, export_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+        raise
+    print(f"finished exporting {count} accounts")
+    return count
+
+def run_periodic_export(export_file, interval, stop):
+    ''' Export balances to export_file every interval seconds until the threading.Event stop is set.
+    Meant to be the target of a background thread. '''
+    while not stop.wait(interval):
+        try:
+            export_balances(export_file)
+        except OSError as e:
+            print(f"ERROR: export to {export_file} failed: {e}")
+
+def start_periodic_export(stop):
+    ''' If EXPORT_FILE is set, start a background thread exporting balances there every EXPORT_INTERVAL seconds
+    until the threading.Event stop is set, and return it. Returns None if exports are turned off. '''
+    if not EXPORT_FILE:
+        return None
+    thread = threading.Thread(target=run_periodic_export, args=(EXPORT_FILE, EXPORT_INTERVAL, stop),
+                              name="periodic-export", daemon=True)
+    thread.start()
+    return thread
+
+def stop_periodic_export(thread, stop):
+    ''' Signal the periodic export thread started by start_periodic_export to stop, and wait for any export in progress to finish. '''
+    stop.set()
+    if thread is not None:
+        thread.join()
+
 ##########################################################
 #                                                        #
 # Bank Server Network Operations                         #
@@ -169,13 +294,17 @@ def save_all_accounts(acct_file = "accounts.txt"):
 def run_network_server(): # CHANGE docstring
     """ Uses a selector from the selectors module to switch between accepting new client connections and servicing existing ones.
     Sets up the server's listening socket at addresss (HOST, PORT). Runs until a KeyBoardInterupt closes the server. All runtime changes to 
-    accounts are saved at this point, in the file ACCT_FILE."""
+    accounts are saved at this point, in the file ACCT_FILE. If EXPORT_FILE is set, account balances are also exported there every
+    EXPORT_INTERVAL seconds from a background thread."""
     # Allows the server to address all client connections (and new connection requests) in a 
     # popcorn-conversation style. We register sockets with the selector. Whenever its select() method is called, 
     # it returns the ones that are ready to deliver or receive data. One socket for evey active client session,
     # plus one to listen for new connections on.
     sel = selectors.DefaultSelector()
     lsock = listening_sock(sel)
+    # Periodic exports run on their own thread so they never pause the select loop.
+    stop_export = threading.Event()
+    export_thread = start_periodic_export(stop_export)
     try:
         while True:
             # Returns all the sockets that are ready to be serviced.
@@ -195,6 +324,7 @@ def run_network_server(): # CHANGE docstring
         print("Caught keyboard interrupt. ", end="")
     finally:
         print("Saving and exiting.")
+        stop_periodic_export(export_thread, stop_export)
         save_all_accounts(ACCT_FILE) 
         lsock.close()
         sel.close()
@@ -206,17 +336,94 @@ def listening_sock(selector, addr=(HOST, PORT)) -> socket.socket:
 
     addr is a known IP address and port number for the listening socket so 
     clients know where to find it. '''
+    lsock = open_listening_sock(addr)
+    lsock.setblocking(False) # so the server can do other things while it waits for new connections.
+    selector.register(lsock, selectors.EVENT_READ, data=None)
+    return lsock
+
+def open_listening_sock(addr=(HOST, PORT)) -> socket.socket:
+    '''Create the server's listening socket, bound to addr and listening for new connections.'''
     lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     lsock.bind(addr)
     lsock.listen()
     print(f"Listening on {addr}")
-    lsock.setblocking(False) # so the server can do other things while it waits for new connections.
-    selector.register(lsock, selectors.EVENT_READ, data=None)
     return lsock
 
+def run_threaded_server(n_threads=None):
+    """ Multithreaded version of run_network_server. The main thread accepts new connections and hands them out round-robin
+    to n_threads I/O threads (IO_THREADS if not given), each of which runs its own selector loop over the connections it was given. Shared account state
+    is protected by the striped locks from acct_lock(). An I/O thread that dies is restarted before it is given another connection.
+    Runs until a KeyBoardInterupt closes the server, then waits for the I/O threads to finish and saves to ACCT_FILE."""
+    if n_threads is None:
+        n_threads = IO_THREADS
+    if n_threads < 1:
+        raise ValueError(f"need at least one I/O thread, got {n_threads}")
+    lsock = open_listening_sock() # Before any thread starts, so a failed bind leaves nothing behind.
+    stop = threading.Event()
+    stop_export = threading.Event()
+    workers = []
+    export_thread = None
+    try:
+        # One (thread, queue of connections handed to it) pair per I/O thread.
+        workers = [start_io_worker(i, queue.Queue(), stop) for i in range(n_threads)]
+        export_thread = start_periodic_export(stop_export)
+        next_worker = 0
+        while True:
+            conn, addr = lsock.accept() # Blocks until a client connects.
+            thread, new_conns = workers[next_worker]
+            if not thread.is_alive():
+                print(f"ERROR: I/O thread {thread.name} died - restarting it")
+                workers[next_worker] = start_io_worker(next_worker, new_conns, stop)
+            new_conns.put((conn, addr))
+            next_worker = (next_worker + 1) % n_threads
+    except KeyboardInterrupt:
+        print("Caught keyboard interrupt. ", end="")
+    finally:
+        print("Saving and exiting.")
+        stop.set()
+        for thread, _ in workers: # Let every in-flight request finish before the balances are saved.
+            thread.join()
+        stop_periodic_export(export_thread, stop_export)
+        save_all_accounts(ACCT_FILE)
+        lsock.close()
+    return
+
+def start_io_worker(i, new_conns, stop):
+    '''Start I/O thread number i servicing the connections put on the queue new_conns. Returns (thread, new_conns).'''
+    thread = threading.Thread(target=io_worker, args=(new_conns, stop), name=f"io-{i}", daemon=True)
+    thread.start()
+    return thread, new_conns
+
+def io_worker(new_conns, stop):
+    '''Body of one I/O thread in the multithreaded server. Registers connections arriving on the queue new_conns with
+    this thread's own selector and services them until the threading.Event stop is set. A connection is only ever
+    serviced by the thread it was handed to, so its session data needs no locking.'''
+    sel = selectors.DefaultSelector()
+    try:
+        while not stop.is_set():
+            while not new_conns.empty():
+                conn, addr = new_conns.get_nowait()
+                register_connection(conn, addr, sel)
+            if not sel.get_map(): # Nothing to service yet, wait for a connection to be handed over.
+                try:
+                    conn, addr = new_conns.get(timeout=WORKER_POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                register_connection(conn, addr, sel)
+            for key, mask in sel.select(timeout=WORKER_POLL_INTERVAL):
+                try:
+                    service_connection(key, mask, sel)
+                except Exception as e: # e.g. the client reset the connection. Only this connection is affected.
+                    print(f"ERROR: connection to {key.data.addr} failed: {e!r}")
+                    close_connection(key.fileobj, key.data, sel)
+    finally:
+        for key in list(sel.get_map().values()):
+            close_connection(key.fileobj, key.data, sel)
+        sel.close()
+
 def accept_connection(lsock, sel) -> type[socket.socket]:
     '''Accepts the connection made to listening socket lsock, registers the new socket 
-    representing that client connection with selector to monitor for READ or WRITE availibility.
+    representing that client connection with selector to monitor for READ availibility (and WRITE, while a response is pending).
 
     Associates the new connection with some data: \n
     \t inb - data that we are in the process of receiving \n
@@ -225,6 +432,10 @@ def accept_connection(lsock, sel) -> type[socket.socket]:
 
     '''
     conn, addr = lsock.accept()  # Should be ready to read
+    register_connection(conn, addr, sel)
+
+def register_connection(conn, addr, sel):
+    '''Registers the newly accepted client connection conn (from address addr) with selector sel, along with its session data.'''
     print(f"Accepted connection from {addr}")
     conn.setblocking(False)
     # Associates data with the new client connection:
@@ -233,14 +444,15 @@ def accept_connection(lsock, sel) -> type[socket.socket]:
     #   addr = client address, already stored by socket object but this allows easier access
     #   auth = account number, identifying an account the client is authorized to access
     data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"", auth='')
-    events = selectors.EVENT_READ | selectors.EVENT_WRITE
-    sel.register(conn, events, data=data)
+    # WRITE availability is only watched while a response is waiting to be sent, see send_pending.
+    sel.register(conn, selectors.EVENT_READ, data=data)
 
 def service_connection(key, mask, sel):
     ''' Services a client connection represented by key. mask indicates the availible I/O operations (read, write).
     Read bytes the connection has delivered and send some out, as needed. 
     Whenever a complete request is recieved from the client (as detected by looking for the ternminal sequence '\\n\\n'), processes
-    that request and registers the response to be sent back by appending it to the data attribute outb. When a client closes a connection,
+    that request and registers the response to be sent back by appending it to the data attribute outb, then sends what it can of it
+    (see send_pending). A request that is not valid UTF-8 gets a 400 response. When a client closes a connection,
     unregister the connection with the selector, and if they had logged in, unmark the bank account they were accessing as busy.  '''
     sock = key.fileobj
     data = key.data
@@ -251,20 +463,44 @@ def service_connection(key, mask, sel):
             if is_complete(data.inb): # If the received data has the message termination sequence '\n\n':
                 request = data.inb[:data.inb.rfind(b'\n\n')] # Strip the message termination and any odd stuff after that, just in case.
                 print(f"Received request: {request !r} from the client.")
-                data.outb += (process_request(request.decode(), data) + '\n\n').encode()
+                try:
+                    response = process_request(request.decode(), data)
+                except UnicodeDecodeError:
+                    response = '400' # Malformed Request
+                data.outb += (response + '\n\n').encode()
                 data.inb = b'' # This request has been fully recevied and processed. No need to store it anymore.
+                send_pending(sock, data, sel) # Usually the whole response goes out right away.
         else: # Client sent empty message to indicate it is closing the connection.
-            print(f"Closing connection to {data.addr}.")
-            unmark_busy(acct_num=data.auth)
-            sel.unregister(sock)
-            sock.close()
+            close_connection(sock, data, sel)
+            return
     if mask & selectors.EVENT_WRITE: # Ready to write
         if data.outb:
-            sent = sock.send(data.outb) 
-            print(f"Sent {data.outb[:sent]!r} to {data.addr}")
-            data.outb = data.outb[sent:]
-            if data.outb:
-                print(f"Remaining data to send: {data.outb!r}")
+            send_pending(sock, data, sel)
+
+def send_pending(sock, data, sel):
+    '''Send as much of data.outb as the socket will take now. The selector watches sock for WRITE availability
+    only while part of outb is left to send; otherwise select() would report the idle socket as writable over and over.'''
+    try:
+        sent = sock.send(data.outb)
+    except BlockingIOError: # Socket buffer full, wait for WRITE availability.
+        sent = 0
+    print(f"Sent {data.outb[:sent]!r} to {data.addr}")
+    data.outb = data.outb[sent:]
+    watching_write = sel.get_key(sock).events & selectors.EVENT_WRITE
+    if data.outb:
+        print(f"Remaining data to send: {data.outb!r}")
+        if not watching_write:
+            sel.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=data)
+    elif watching_write: # All sent, stop watching for WRITE until a response is left over again.
+        sel.modify(sock, selectors.EVENT_READ, data=data)
+
+def close_connection(sock, data, sel):
+    '''Unregister the client connection sock from the selector and close it. If the client had logged in, 
+    unmark the bank account they were accessing as busy.'''
+    print(f"Closing connection to {data.addr}.")
+    unmark_busy(acct_num=data.auth)
+    sel.unregister(sock)
+    sock.close()
 
 def is_complete(received:bytes) -> bool:
     '''True if received data has the termination sequence '\\n\\n', which means that the client has finished sending the message.
@@ -290,16 +526,16 @@ def process_request(request:str, session_data) -> str:
         if acct_num not in ALL_ACCOUNTS: return '400 Unknown Account Number'
              
         if command == 'LOGIN':
-            print('Attempting Login.')
+            log('Attempting Login.')
             return login(acct_num, request[2], session_data)
         elif command == 'BALANCE':
-            print('Attempting To Get Balance.')
+            log('Attempting To Get Balance.')
             return get_bal(acct_num, session_data)
         elif command == 'DEPOSIT':
-            print('Attempting Deposit.')
+            log('Attempting Deposit.')
             return deposit(acct_num, request[2], session_data)
         elif command == 'WITHDRAW':
-            print('Attempting Withdrawl.')
+            log('Attempting Withdrawl.')
             return withdraw(acct_num, request[2], session_data)
     except IndexError:
         pass
@@ -311,16 +547,16 @@ def login(acct_num, pin, session_data):
     Returns response for client. The first line has the status code. If the account was busy but the credentials
     were valid, there is a second line with the IP address of the client currently accessing the account.'''
     if ALL_ACCOUNTS[acct_num].acct_pin == pin: # Correct Credentials.
-        if acct_num in ACTIVE_ACCOUNTS: # But account is busy, can't be accessed.
+        # Mark this account as busy, unless another client got there first. 
+        busyIP = mark_busy(acct_num, busyIP=session_data.addr[0]) # addr takes the form (host IP, port number). Just want the IP.
+        if busyIP: # Account is busy, can't be accessed.
             # First line: Status code
             # Second line: IP address of the client currently accessing the account
-            return f'300\n{ACTIVE_ACCOUNTS[acct_num]}'
+            return f'300\n{busyIP}'
         # Successful Login!
-        # Mark this account as busy:
-        mark_busy(acct_num, busyIP=session_data.addr[0]) # addr takes the form (host IP, port number). Just want the IP.
         # if the client was already logged into a different account, unmark that one as busy.
         if session_data.auth and session_data.auth != acct_num: 
-            unmark_busy(acct_num)
+            unmark_busy(session_data.auth)
         # Identifies that the client is authorized to access this account:
         session_data.auth = acct_num
         return '200' # Success!
@@ -330,15 +566,22 @@ def login(acct_num, pin, session_data):
 
 def mark_busy(acct_num, busyIP):
     '''Marks the given account number as busy so another client can't access it at the same time.
-    Associates the IP address of the client that's currently accessing the account with the account number.'''
-    ACTIVE_ACCOUNTS[acct_num] = busyIP
-    print(f'Account {acct_num} is now being accessed by client at {busyIP}.')
+    Associates the IP address of the client that's currently accessing the account with the account number.
+    The check and the marking happen atomically: returns None if the account was marked, or the IP address
+    of the client already accessing it if the account was busy (in which case nothing changes).'''
+    with acct_lock(acct_num):
+        if acct_num in ACTIVE_ACCOUNTS:
+            return ACTIVE_ACCOUNTS[acct_num]
+        ACTIVE_ACCOUNTS[acct_num] = busyIP
+    log(f'Account {acct_num} is now being accessed by client at {busyIP}.')
+    return None
 
 def unmark_busy(acct_num):
     '''Unmarks the given account number as busy so another client can access it.'''
-    if acct_num in ACTIVE_ACCOUNTS:
-        del ACTIVE_ACCOUNTS[acct_num]
-        print(f'Account {acct_num} freed up for access.')
+    with acct_lock(acct_num):
+        if ACTIVE_ACCOUNTS.pop(acct_num, None) is None:
+            return
+    log(f'Account {acct_num} freed up for access.')
 
 def get_bal(acct_num, session_data):
     '''Get account balance associated with the given account number. The client must be logged in first.'''
@@ -416,6 +659,193 @@ def demo_bank_server():
         print(f"Withdrawal failed as expected, code {code}")
     print("End of demo!")
 
+def check_export():
+    """ Round-trips the loaded accounts through export_balances in CSV (gzip compressed) and JSONL, with
+    EXPORT_CHUNK_ROWS smaller than the number of accounts so several chunks are written, and checks that a failed
+    export leaves the previous file in place and no temporary file behind. Prints each result and returns True
+    if all of them checked out. Requires at least two loaded accounts. """
+    global EXPORT_CHUNK_ROWS
+    expected = {acct.acct_number: acct.acct_balance for acct in iter_accounts()}
+    chunk_rows = EXPORT_CHUNK_ROWS
+    EXPORT_CHUNK_ROWS = max(1, len(expected) // 3)
+    all_ok = True
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_file = os.path.join(tmp_dir, "balances.csv.gz")
+            jsonl_file = os.path.join(tmp_dir, "balances.jsonl")
+            export_balances(csv_file)
+            with gzip.open(csv_file, "rt", newline="") as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                got = {num: float(bal) for num, bal in reader}
+            ok = header == ["acct_number", "balance"] and got == expected
+            print(f"CSV (gzip) export round trip: {'OK' if ok else 'FAILED'}")
+            all_ok = all_ok and ok
+
+            export_balances(jsonl_file)
+            with open(jsonl_file) as f:
+                got = {row["acct_number"]: row["balance"] for row in map(json.loads, f)}
+            ok = got == expected
+            print(f"JSONL export round trip: {'OK' if ok else 'FAILED'}")
+            all_ok = all_ok and ok
+
+            def failing_rows():
+                yield from iter_balance_rows()
+                raise OSError("simulated failure")
+            try:
+                export_balances(jsonl_file, rows=failing_rows())
+                ok = False
+            except OSError:
+                with open(jsonl_file) as f:
+                    ok = sum(1 for _ in f) == len(expected)
+            ok = ok and sorted(os.listdir(tmp_dir)) == ["balances.csv.gz", "balances.jsonl"]
+            print(f"Failed export leaves previous file and no temp file: {'OK' if ok else 'FAILED'}")
+            all_ok = all_ok and ok
+    finally:
+        EXPORT_CHUNK_ROWS = chunk_rows
+    return all_ok
+
+def stress_bank_server(hot_accounts=("ac-12345", "wf-14351"), thread_counts=(1, 2, 4, 8), ops_per_thread=2000,
+                       forced_ops_per_thread=500):
+    """ Hammers a few hot accounts from many threads at once and checks that no update is lost and no account is ever
+    logged into by two clients at the same time. For each thread count, stress_sessions and stress_balances run twice:
+    once with a thread switch forced on every bytecode of the code that touches shared account state (see forced_yields),
+    so any unprotected read-modify-write or check-then-set actually interleaves (forced_ops_per_thread operations
+    per thread, as this is slow), and once untouched for timing (ops_per_thread operations per thread).
+    Prints the in-process throughput of the second run (no sockets involved, so this measures the locking,
+    not the I/O threads of run_threaded_server). Returns True if every run checked out. """
+    global QUIET
+    quiet = QUIET
+    QUIET = True # The per-request messages would swamp the timing.
+    all_ok = True
+    try:
+        for n_threads in thread_counts:
+            ok = True
+            for force, ops in ((True, forced_ops_per_thread), (False, ops_per_thread)):
+                sessions_ok, session_ops, session_time = stress_sessions(n_threads, hot_accounts, ops, force)
+                balances_ok, balance_ops, balance_time = stress_balances(n_threads, hot_accounts, ops, force)
+                ok = ok and sessions_ok and balances_ok
+            all_ok = all_ok and ok
+            print(f"{n_threads:>2} threads: {session_ops / session_time:>9.0f} requests/s through process_request, "
+                  f"{balance_ops / balance_time:>9.0f} balance updates/s - {'OK' if ok else 'FAILED'}")
+    finally:
+        QUIET = quiet
+    return all_ok
+
+def forced_yields():
+    """ Return a trace function that makes the running thread give up the GIL before every bytecode of
+    BankAccount.deposit, BankAccount.withdraw, login and mark_busy, so other threads get to run in the
+    middle of them, even halfway through a single line like a balance update. Without this, CPython rarely
+    switches threads inside such short functions. """
+    code = {BankAccount.deposit.__code__, BankAccount.withdraw.__code__, login.__code__, mark_busy.__code__}
+    def yield_each_opcode(frame, event, arg):
+        if event == 'opcode':
+            time.sleep(0)
+        return yield_each_opcode
+    def tracer(frame, event, arg):
+        if frame.f_code not in code:
+            return None
+        frame.f_trace_opcodes = True
+        return yield_each_opcode
+    return tracer
+
+def run_stress_threads(n_threads, client, force_yields=False):
+    """ Run client(i) on n_threads threads, released together. If force_yields, each thread runs under the
+    forced_yields trace function. Returns (elapsed time in seconds, number of threads that raised an exception). """
+    start = threading.Barrier(n_threads + 1)
+    tracer = forced_yields() if force_yields else None
+    crashed = []
+    def run(i):
+        sys.settrace(tracer)
+        start.wait()
+        try:
+            client(i)
+        except Exception as e:
+            crashed.append(i)
+            print(f"Stress client {i} crashed: {e!r}")
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n_threads)]
+    for t in threads:
+        t.start()
+    start.wait()
+    began = time.perf_counter()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - began, len(crashed)
+
+def check_balances(start_bals, deposited, withdrawn):
+    """ Return the number of accounts whose balance differs from its starting balance plus the successful deposits
+    minus the successful withdrawals (of 1.0 each), printing each one. """
+    lost = 0
+    for num, start_bal in start_bals.items():
+        expected = round(start_bal + deposited[num] - withdrawn[num], 2)
+        if ALL_ACCOUNTS[num].acct_balance != expected:
+            lost += 1
+            print(f"Lost update on {num}: balance {ALL_ACCOUNTS[num].acct_balance}, expected {expected}")
+    return lost
+
+def stress_sessions(n_threads, hot_accounts, ops_per_thread, force_yields=False):
+    """ Each thread is a client session that repeatedly logs into one of hot_accounts through process_request,
+    deposits and withdraws 1.0 while logged in, then logs out. Counts how many sessions are inside the
+    logged-in span of each account at once; more than one is a double login. Returns (ok, requests, seconds). """
+    start_bals = {num: ALL_ACCOUNTS[num].acct_balance for num in hot_accounts}
+    holders = {num: 0 for num in hot_accounts} # how many sessions are logged into each account right now
+    deposited = {num: 0 for num in hot_accounts}
+    withdrawn = {num: 0 for num in hot_accounts}
+    totals = {"double_logins": 0, "requests": 0}
+    tally_lock = threading.Lock()
+
+    def client(i):
+        session = types.SimpleNamespace(addr=(f"10.0.0.{i}", 50000 + i), auth='')
+        for op in range(ops_per_thread):
+            num = hot_accounts[op % len(hot_accounts)]
+            requests = 1
+            if process_request(f"LOGIN {num} {ALL_ACCOUNTS[num].acct_pin}", session) == '200':
+                with tally_lock:
+                    holders[num] += 1
+                    if holders[num] > 1:
+                        totals["double_logins"] += 1
+                deposit_ok = process_request(f"DEPOSIT {num} 1.0", session) == '200'
+                withdraw_ok = process_request(f"WITHDRAW {num} 1.0", session) == '200'
+                requests += 2
+                with tally_lock:
+                    holders[num] -= 1
+                    deposited[num] += deposit_ok
+                    withdrawn[num] += withdraw_ok
+                # Log out, as service_connection does when the client closes its connection.
+                unmark_busy(acct_num=session.auth)
+                session.auth = ''
+            with tally_lock:
+                totals["requests"] += requests
+
+    elapsed, crashed = run_stress_threads(n_threads, client, force_yields)
+    lost = check_balances(start_bals, deposited, withdrawn)
+    if totals["double_logins"]:
+        print(f"{totals['double_logins']} double logins")
+    ok = crashed == 0 and lost == 0 and totals["double_logins"] == 0 and not ACTIVE_ACCOUNTS
+    return ok, totals["requests"], elapsed
+
+def stress_balances(n_threads, hot_accounts, ops_per_thread, force_yields=False):
+    """ Every thread deposits and withdraws 1.0 directly on the same hot_accounts. The busy marking normally keeps
+    one session per account, so this is what exercises the account locks in deposit/withdraw on their own.
+    Returns (ok, balance updates, seconds). """
+    start_bals = {num: ALL_ACCOUNTS[num].acct_balance for num in hot_accounts}
+    deposited = {num: 0 for num in hot_accounts}
+    withdrawn = {num: 0 for num in hot_accounts}
+    tally_lock = threading.Lock()
+
+    def client(i):
+        for op in range(ops_per_thread):
+            acct = ALL_ACCOUNTS[hot_accounts[op % len(hot_accounts)]]
+            deposit_ok = acct.deposit(1.0) == 0
+            withdraw_ok = acct.withdraw(1.0) == 0
+            with tally_lock:
+                deposited[acct.acct_number] += deposit_ok
+                withdrawn[acct.acct_number] += withdraw_ok
+
+    elapsed, crashed = run_stress_threads(n_threads, client, force_yields)
+    ok = crashed == 0 and check_balances(start_bals, deposited, withdrawn) == 0
+    return ok, n_threads * ops_per_thread * 2, elapsed
+
 ##########################################################
 #                                                        #
 # Bank Server Startup Operations                         #
@@ -427,7 +857,29 @@ def demo_bank_server():
 if __name__ == "__main__":
     # on startup, load all the accounts from the account file
     load_all_accounts(ACCT_FILE)
+    # "bank_server.py export FILE" writes a one-off balance export and exits instead of serving.
+    if len(sys.argv) >= 2 and sys.argv[1] == "export":
+        if len(sys.argv) != 3:
+            print(f"usage: {sys.argv[0]} export FILE  (FILE ending in .csv or .jsonl, optionally followed by .gz)")
+            sys.exit(2)
+        export_balances(sys.argv[2])
+        sys.exit(0)
+    # "bank_server.py checkexport" round-trips the loaded accounts through both export formats and exits.
+    if len(sys.argv) == 2 and sys.argv[1] == "checkexport":
+        sys.exit(0 if check_export() else 1)
+    # "bank_server.py stress" runs the multithreaded contention check and exits without saving.
+    if len(sys.argv) == 2 and sys.argv[1] == "stress":
+        sys.exit(0 if stress_bank_server() else 1)
+    # "bank_server.py threads N" serves clients from N I/O threads instead of the single select loop.
+    if len(sys.argv) >= 2 and sys.argv[1] == "threads":
+        if not (len(sys.argv) == 3 and sys.argv[2].isdigit() and int(sys.argv[2]) > 0):
+            print(f"usage: {sys.argv[0]} threads N  (N is the number of I/O threads, at least 1)")
+            sys.exit(2)
+        IO_THREADS = int(sys.argv[2])
     # uncomment the next line in order to run a simple demo of the server in action
     #demo_bank_server()
-    run_network_server()
+    if IO_THREADS > 0:
+        run_threaded_server(IO_THREADS)
+    else:
+        run_network_server()
     print("bank server exiting...")